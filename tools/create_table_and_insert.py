@@ -10,25 +10,40 @@ Behaviour:
   - Every sheet column becomes a TEXT column; column names are sanitised from
     the raw header strings.
   - Empty strings from the sheet become NULL in the database.
-  - DROP, CREATE, and INSERT are sent as a single SQL string — if any
-    statement fails the later ones do not execute.
+  - If SUPABASE_DB_URL is set, DROP + CREATE + a binary COPY of the rows run
+    in one transaction over a direct Postgres connection (no SQL-literal
+    escaping, no per-row SQL parsing).  Any failure leaves the old table.
+  - Otherwise sheet_data.json is read through once to validate it, then
+    DROP + CREATE are sent to the Management API as one request, followed by
+    INSERT statements of INSERT_CHUNK_SIZE rows each, with up to
+    INSERT_CONCURRENCY in flight.  A failed INSERT leaves the new table in
+    place (empty or partially filled).
 
 Requires:
-  - .env              (SUPABASE_PROJECT_REF, SUPABASE_MANAGEMENT_KEY, SUPABASE_TABLE)
+  - .env              (SUPABASE_TABLE, plus SUPABASE_DB_URL or
+                       SUPABASE_PROJECT_REF + SUPABASE_MANAGEMENT_KEY;
+                       optional INSERT_CHUNK_SIZE, INSERT_CONCURRENCY)
   - .tmp/sheet_data.json  (output of fetch_google_sheet.py)
 
 Install dependencies:
-  pip install requests python-dotenv
+  pip install requests "psycopg[binary]" ijson python-dotenv
 """
 
-import json
 import os
 import re
 import sys
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from itertools import chain, islice
+from operator import itemgetter
 from pathlib import Path
 
+import ijson
+import psycopg
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------------------------------------------------------------------
 # Config
@@ -38,13 +53,19 @@ load_dotenv(BASE_DIR / ".env")
 
 PROJECT_REF       = os.getenv("SUPABASE_PROJECT_REF")
 MANAGEMENT_KEY    = os.getenv("SUPABASE_MANAGEMENT_KEY")
+DB_URL            = os.getenv("SUPABASE_DB_URL")         # optional: direct Postgres (DDL + COPY)
 TABLE_NAME        = os.getenv("SUPABASE_TABLE")
 EXTRA_COLUMNS_RAW = os.getenv("EXTRA_COLUMNS", "")   # comma-separated: last_messaged,other_col
+INSERT_CHUNK_SIZE  = int(os.getenv("INSERT_CHUNK_SIZE", "1000"))  # rows per Management API INSERT
+INSERT_CONCURRENCY = int(os.getenv("INSERT_CONCURRENCY", "4"))    # INSERT requests in flight
 INPUT_PATH        = BASE_DIR / ".tmp" / "sheet_data.json"
 
 # ---------------------------------------------------------------------------
 # Column-name sanitization
 # ---------------------------------------------------------------------------
+_NONIDENT_RE       = re.compile(r"[^a-z0-9_]")
+_UNDERSCORE_RUN_RE = re.compile(r"_+")
+
 def sanitize_column_name(raw: str) -> str:
     """
     Turn an arbitrary sheet-header string into a valid PostgreSQL identifier.
@@ -64,8 +85,8 @@ def sanitize_column_name(raw: str) -> str:
         return "_unnamed"
 
     name = name.lower()
-    name = re.sub(r"[^a-z0-9_]", "_", name)
-    name = re.sub(r"_+", "_", name)
+    name = _NONIDENT_RE.sub("_", name)
+    name = _UNDERSCORE_RUN_RE.sub("_", name)
     name = name.lstrip("_")
 
     if not name:
@@ -81,111 +102,146 @@ def build_column_map(headers: list[str]) -> list[tuple[str, str]]:
     """
     Return [(original_header, sanitized_name), ...] preserving header order.
     Duplicates after sanitization are resolved by appending _2, _3, …
+    (the base is shortened so the suffix always fits in 63 characters).
     """
+    # name -> next suffix to try if another header sanitizes to the same name.
     # Reserve "id" — it's used by the auto-added SERIAL PRIMARY KEY column.
     # Any sheet header that sanitizes to "id" will be renamed to "id_2", etc.
-    seen: dict[str, int] = {"id": 1}
+    seen: dict[str, int] = {"id": 2}
     result: list[tuple[str, str]] = []
 
     for header in headers:
         base = sanitize_column_name(header)
 
         if base not in seen:
-            seen[base] = 1
+            seen[base] = 2
             result.append((header, base))
-        else:
-            seen[base] += 1
-            candidate = f"{base}_{seen[base]}"[:63]
-            while candidate in seen:
-                seen[base] += 1
-                candidate = f"{base}_{seen[base]}"[:63]
-            seen[candidate] = 1
-            result.append((header, candidate))
+            continue
+
+        idx = seen[base]
+        while True:
+            suffix    = "_" + str(idx)
+            candidate = base[:63 - len(suffix)] + suffix
+            if candidate not in seen:
+                break
+            idx += 1
+        # Resume from the next suffix on the following collision — no rescans
+        seen[base]      = idx + 1
+        seen[candidate] = 2
+        result.append((header, candidate))
 
     return result
 
 # ---------------------------------------------------------------------------
 # Data loading & transformation
 # ---------------------------------------------------------------------------
-def load_rows() -> list[dict]:
-    """Read and return the row list from the intermediate JSON file."""
+def load_rows() -> Iterator[dict]:
+    """
+    Stream row dicts from the intermediate JSON file, one at a time.
+
+    The file is parsed incrementally, so only the row currently being
+    processed is held in memory rather than the whole array.
+    """
     if not INPUT_PATH.exists():
         raise FileNotFoundError(
             f"{INPUT_PATH} not found. Run fetch_google_sheet.py first."
         )
-    with open(INPUT_PATH, encoding="utf-8") as f:
-        rows = json.load(f)
-    if not isinstance(rows, list):
-        raise ValueError(f"Expected a JSON array in {INPUT_PATH}; got {type(rows).__name__}")
-    return rows
+    return _iter_json_array(INPUT_PATH)
+
+
+def _iter_json_array(path: Path) -> Iterator[dict]:
+    with open(path, "rb") as f:
+        events = ijson.parse(f, use_float=True)
+        _, event, _ = next(events, (None, None, None))
+        if event != "start_array":
+            raise ValueError(f"Expected a JSON array in {path}; got {event or 'nothing'}")
+        yield from ijson.items(events, "item")
 
 
 # Known test entries to strip out (case-insensitive match on given + family name)
-TEST_ENTRIES = [
+TEST_ENTRIES = frozenset([
     ("john", "doe"),
     ("test", "subject"),
-]
+])
+# Given names that appear in any test entry — most rows miss here, which
+# saves normalizing family_name for them
+_TEST_GIVENS = frozenset(given for given, _ in TEST_ENTRIES)
 
-def filter_rows(rows: list[dict]) -> list[dict]:
+def filter_rows(rows: Iterable[dict], stats: dict | None = None) -> Iterator[dict]:
     """
-    Remove rows that should not be inserted:
+    Lazily drop rows that should not be inserted:
       1. Known test entries (given_name + family_name pairs).
       2. Rows with no email AND no phone — at least one is required.
+
+    If `stats` is given, its "seen" and "kept" counts are updated as the
+    rows stream through.
     """
-    kept = []
+    if stats is None:
+        stats = {}
+    stats.setdefault("seen", 0)
+    stats.setdefault("kept", 0)
+
     for row in rows:
-        given  = row.get("given_name", "").strip().lower()
-        family = row.get("family_name", "").strip().lower()
-        email  = row.get("email_address", "").strip()
-        phone  = row.get("phone_number", "").strip()
+        stats["seen"] += 1
 
-        # Drop known test entries
-        if (given, family) in TEST_ENTRIES:
+        # Drop rows missing both email and phone — checked first, since it
+        # needs no lowercasing and skips the name work for dropped rows
+        if not row.get("email_address", "").strip() and not row.get("phone_number", "").strip():
             continue
 
-        # Drop rows missing both email and phone
-        if not email and not phone:
+        # Drop known test entries
+        given = row.get("given_name", "").strip().lower()
+        if given in _TEST_GIVENS and (given, row.get("family_name", "").strip().lower()) in TEST_ENTRIES:
             continue
 
-        kept.append(row)
-    return kept
+        stats["kept"] += 1
+        yield row
 
 
-def rows_to_values(rows: list[dict], headers: list[str]) -> list[list]:
+def rows_to_values(rows: Iterable[dict], headers: list[str]) -> Iterator[list]:
     """
-    Convert each row-dict into a list aligned to the header order.
-    Empty strings become None (→ SQL NULL).  Missing keys also become None.
+    Lazily convert each row-dict into a list aligned to the header order.
+    Empty strings become None (→ SQL NULL).
+
+    Every row must carry every header — guaranteed by the row padding in
+    fetch_google_sheet.py — so all fields are fetched with one itemgetter call.
     """
-    return [
-        [None if (v := row.get(h, "")) == "" else v for h in headers]
-        for row in rows
-    ]
+    if len(headers) == 1:
+        # itemgetter with a single key returns the bare value, not a tuple
+        (h,) = headers
+        return ([None if row[h] == "" else row[h]] for row in rows)
+
+    get = itemgetter(*headers)
+    return ([None if v == "" else v for v in get(row)] for row in rows)
 
 # ---------------------------------------------------------------------------
 # SQL building
 # ---------------------------------------------------------------------------
-def escape_sql_value(val) -> str:
-    """Escape a single value for safe inclusion in a SQL VALUES literal."""
-    if val is None:
-        return "NULL"
-    # Standard SQL: single quotes inside a string are escaped by doubling them
-    return "'" + str(val).replace("'", "''") + "'"
-
-
-def build_values_clause(rows: list[list]) -> str:
-    """Turn a list of row-lists into a VALUES clause: (v1, v2), (v3, v4), …"""
-    return ",\n".join(
-        "(" + ", ".join(escape_sql_value(v) for v in row) + ")"
+# Standard SQL: single quotes inside a string are escaped by doubling them
+_SQL_ESCAPE = str.maketrans({"'": "''"})
+
+def build_values_clause(rows: Iterable[list]) -> str:
+    """
+    Turn a list of row-lists into a VALUES clause: (v1, v2), (v3, v4), …
+    None becomes NULL; everything else becomes an escaped string literal.
+    """
+    # The escape is written inline rather than as a helper — this runs once
+    # per cell.  List comprehensions (not generators) so str.join gets a
+    # ready-made list instead of pulling items through generator frames.
+    return ",\n".join([
+        "(" + ", ".join([
+            "NULL" if v is None else "'" + str(v).translate(_SQL_ESCAPE) + "'"
+            for v in row
+        ]) + ")"
         for row in rows
-    )
+    ])
 
 
-def build_full_sql(table: str, col_names: list[str], value_rows: list[list], extra_cols: list[str] | None = None) -> str:
+def build_create_sql(table: str, col_names: list[str], extra_cols: list[str] | None = None) -> str:
     """
-    Build the complete multi-statement SQL:
+    Build the DDL statements:
       DROP TABLE IF EXISTS …;
       CREATE TABLE … (id SERIAL PRIMARY KEY, sheet cols…, extra cols…);
-      INSERT INTO … VALUES …;   (sheet cols only — extra cols default to NULL)
     """
     # DROP
     drop = f'DROP TABLE IF EXISTS "{table}";'
@@ -200,16 +256,74 @@ def build_full_sql(table: str, col_names: list[str], value_rows: list[list], ext
         f');'
     )
 
-    # INSERT — sheet columns only; extra columns are left as NULL
+    return f"{drop}\n{create}"
+
+
+def build_insert_sql(table: str, col_names: list[str], value_rows: Iterable[list]) -> str:
+    """
+    Build one INSERT INTO … VALUES …; statement.
+    Sheet columns only — extra columns are left as NULL.
+    """
     cols_list = ", ".join(f'"{col}"' for col in col_names)
     values    = build_values_clause(value_rows)
-    insert    = f'INSERT INTO "{table}" ({cols_list}) VALUES\n{values};'
+    return f'INSERT INTO "{table}" ({cols_list}) VALUES\n{values};'
+
 
-    return f"{drop}\n{create}\n{insert}"
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yield successive lists of up to `size` items from iterable."""
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+# ---------------------------------------------------------------------------
+# Direct Postgres
+# ---------------------------------------------------------------------------
+def load_table_direct(create_sql: str, table: str, col_names: list[str], value_rows: Iterable[list]):
+    """
+    Recreate the table and bulk-load value_rows over a direct Postgres
+    connection (SUPABASE_DB_URL), with COPY … FROM STDIN in binary format.
+
+    DROP + CREATE + COPY run in one transaction, so if the stream fails
+    part-way (truncated JSON, a row missing a header, …) everything rolls
+    back and the previous table is left untouched.
+
+    The table is freshly created, so this is a cold one-shot load — COPY
+    streams tuples without parsing any SQL per row, and psycopg handles
+    NULLs and encoding, so none of the SQL-literal escaping above is needed.
+    value_rows is consumed lazily: rows are parsed, filtered, and loaded in
+    a single streaming pass.
+    """
+    cols_list = ", ".join(f'"{col}"' for col in col_names)
+    copy_sql  = f'COPY "{table}" ({cols_list}) FROM STDIN (FORMAT BINARY)'
+
+    # prepare_threshold=None: Supabase's transaction pooler (port 6543) does
+    # not support server-side prepared statements.
+    with psycopg.connect(DB_URL, prepare_threshold=None) as conn:
+        with conn.cursor() as cur:
+            cur.execute(create_sql)
+            with cur.copy(copy_sql) as copy:
+                # Binary COPY needs the column types up front; every sheet column
+                # is TEXT and every cell is a str (or None) from fetch_google_sheet.py
+                copy.set_types(["text"] * len(col_names))
+                for row in value_rows:
+                    copy.write_row(row)
 
 # ---------------------------------------------------------------------------
 # Management API
 # ---------------------------------------------------------------------------
+# One pooled session for every Management API call, so repeated queries reuse
+# the same TCP + TLS connection instead of handshaking each time.  The pool
+# holds one connection per concurrent INSERT, so none are discarded.
+# POST is not in urllib3's default allowed_methods, so only connection
+# failures are retried — a query that may already have run is never re-sent.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=max(INSERT_CONCURRENCY, 1),
+    max_retries=Retry(total=3, backoff_factor=0.3),
+))
+
+HTTP_TIMEOUT = (10, 300)   # (connect, read) seconds — large INSERTs can take a while
+
 def run_query(sql: str):
     """POST sql to the Supabase Management API query endpoint."""
     url = f"https://api.supabase.com/v1/projects/{PROJECT_REF}/database/query"
@@ -217,7 +331,7 @@ def run_query(sql: str):
         "Authorization": f"Bearer {MANAGEMENT_KEY}",
         "Content-Type":  "application/json",
     }
-    resp = requests.post(url, headers=headers, json={"query": sql})
+    resp = _SESSION.post(url, headers=headers, json={"query": sql}, timeout=HTTP_TIMEOUT)
 
     if resp.status_code not in (200, 201):
         print(f"\n  [ERR] Management API returned {resp.status_code}:", file=sys.stderr)
@@ -226,34 +340,64 @@ def run_query(sql: str):
 
     return resp.json()
 
+
+def insert_rows_via_api(table: str, col_names: list[str], value_rows: Iterable[list]):
+    """
+    INSERT value_rows through the Management API, INSERT_CHUNK_SIZE rows per
+    statement, with up to INSERT_CONCURRENCY requests in flight on the
+    pooled session.  Each chunk commits on its own.
+
+    Chunk SQL is only built when a request slot frees up, so at most
+    INSERT_CONCURRENCY statements exist at once — memory stays O(chunk),
+    never O(sheet).
+    """
+    with ThreadPoolExecutor(max_workers=INSERT_CONCURRENCY) as pool:
+        pending = set()
+        try:
+            for chunk in chunked(value_rows, INSERT_CHUNK_SIZE):
+                if len(pending) >= INSERT_CONCURRENCY:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(pool.submit(run_query, build_insert_sql(table, col_names, chunk)))
+
+            for future in as_completed(pending):
+                future.result()
+        except BaseException:
+            # Don't send the remaining chunks once one has failed
+            for future in pending:
+                future.cancel()
+            raise
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
 def main():
     # ----- validate config -------------------------------------------------
-    if not PROJECT_REF:
+    # The Management API is only needed when there is no direct connection
+    if not DB_URL and not PROJECT_REF:
         raise ValueError("SUPABASE_PROJECT_REF is not set in .env")
-    if not MANAGEMENT_KEY:
+    if not DB_URL and not MANAGEMENT_KEY:
         raise ValueError("SUPABASE_MANAGEMENT_KEY is not set in .env")
     if not TABLE_NAME:
         raise ValueError("SUPABASE_TABLE is not set in .env")
-
-    # ----- load & filter data ---------------------------------------------
-    rows = load_rows()
-    if not rows:
-        print("sheet_data.json is empty — nothing to insert.")
-        sys.exit(0)
-
-    before = len(rows)
-    rows   = filter_rows(rows)
-    print(f"  Filtered: {before} raw rows -> {len(rows)} after removing test entries & no-contact rows.")
-
-    if not rows:
-        print("  No rows left after filtering — nothing to insert.")
+    if INSERT_CHUNK_SIZE < 1:
+        raise ValueError(f"INSERT_CHUNK_SIZE must be at least 1; got {INSERT_CHUNK_SIZE}")
+    if INSERT_CONCURRENCY < 1:
+        raise ValueError(f"INSERT_CONCURRENCY must be at least 1; got {INSERT_CONCURRENCY}")
+
+    # ----- load & filter data (streamed) -----------------------------------
+    stats = {}
+    rows  = filter_rows(load_rows(), stats)
+    first = next(rows, None)
+
+    if first is None:
+        print(f"  No rows to insert — {stats['seen']} raw row(s), none left after filtering.")
         sys.exit(0)
 
     # All rows have the same keys after the row-padding fix in fetch_google_sheet.py
-    original_headers = list(rows[0].keys())
+    original_headers = list(first.keys())
+    rows = chain([first], rows)
 
     # ----- build column mapping --------------------------------------------
     col_map         = build_column_map(original_headers)
@@ -262,7 +406,7 @@ def main():
     # ----- print mapping report --------------------------------------------
     print("=" * 60)
     print(f"  Table : {TABLE_NAME}")
-    print(f"  Cols  : {len(sanitized_names)}  |  Rows : {len(rows)}")
+    print(f"  Cols  : {len(sanitized_names)}")
     print("-" * 60)
     print(f"  {'Original Header':<30} {'Sanitized Name'}")
     print(f"  {'-'*30} {'-'*28}")
@@ -271,20 +415,36 @@ def main():
         print(f"  {orig:<30} {san}{flag}")
     print("=" * 60)
 
-    # ----- convert rows (empty string → None) -----------------------------
-    value_rows = rows_to_values(rows, original_headers)
-
     # ----- parse extra columns (not in sheet — created as blank TEXT) -------
     extra_cols = [sanitize_column_name(c) for c in EXTRA_COLUMNS_RAW.split(",") if c.strip()]
     if extra_cols:
         print(f"\n  Extra columns (will be NULL): {extra_cols}")
 
-    # ----- build & send SQL ------------------------------------------------
-    sql = build_full_sql(TABLE_NAME, sanitized_names, value_rows, extra_cols)
-
-    print(f"\n  Sending to Supabase Management API ...")
-    run_query(sql)
-    print(f"\n  [OK] {len(value_rows)} row(s) inserted into \"{TABLE_NAME}\".\n")
+    # ----- create table & insert (empty string → None) --------------------
+    create_sql = build_create_sql(TABLE_NAME, sanitized_names, extra_cols)
+
+    if DB_URL:
+        print(f"\n  Recreating table and loading rows over direct Postgres connection (COPY) ...")
+        load_table_direct(create_sql, TABLE_NAME, sanitized_names, rows_to_values(rows, original_headers))
+    else:
+        # The DDL below commits on its own, so read the whole file first —
+        # a truncated or malformed sheet_data.json must fail before the
+        # existing table is dropped.  Rows are discarded as they are checked.
+        print(f"\n  Validating {INPUT_PATH.name} ...")
+        for _ in rows_to_values(rows, original_headers):
+            pass
+
+        print(f"  Creating table via Supabase Management API ...")
+        run_query(create_sql)
+
+        print(f"  Inserting rows via Supabase Management API "
+              f"({INSERT_CHUNK_SIZE} rows/request, {INSERT_CONCURRENCY} in flight) ...")
+        stats = {}
+        insert_rows_via_api(TABLE_NAME, sanitized_names,
+                            rows_to_values(filter_rows(load_rows(), stats), original_headers))
+
+    print(f"\n  Filtered: {stats['seen']} raw rows -> {stats['kept']} after removing test entries & no-contact rows.")
+    print(f"\n  [OK] {stats['kept']} row(s) inserted into \"{TABLE_NAME}\".\n")
 
 
 if __name__ == "__main__":
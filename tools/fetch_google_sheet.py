@@ -3,19 +3,30 @@ fetch_google_sheet.py
 ---------------------
 Reads all rows from a Google Sheet and writes them to .tmp/sheet_data.json.
 
+Cells are stored as strings.  By default they are exactly what the sheet
+displays (FORMATTED_VALUE).  Setting GOOGLE_VALUE_RENDER_OPTION=UNFORMATTED_VALUE
+skips the Sheets display formatting for large sheets — numbers then come
+back raw (e.g. "1234.5" instead of "$1,234.50"), dates stay formatted.
+
 Requires:
   - credentials.json  (Google OAuth client credentials)
   - token.json        (cached OAuth token; auto-refreshed if expired)
-  - .env              (GOOGLE_SHEET_ID, GOOGLE_SHEET_NAME)
+  - .env              (GOOGLE_SHEET_ID, GOOGLE_SHEET_NAME; optional GOOGLE_VALUE_RENDER_OPTION)
 
 Install dependencies:
-  pip install google-auth google-auth-oauthlib google-api-python-client python-dotenv
+  pip install google-auth google-auth-oauthlib google-api-python-client orjson python-dotenv
 """
 
 import json
 import os
+from itertools import zip_longest
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # stdlib json fallback — same output, just slower
+    orjson = None
+
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -30,6 +41,7 @@ load_dotenv(BASE_DIR / ".env")
 
 SHEET_ID   = os.getenv("GOOGLE_SHEET_ID")
 SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME", "Sheet1")
+VALUE_RENDER_OPTION = os.getenv("GOOGLE_VALUE_RENDER_OPTION", "FORMATTED_VALUE")
 OUTPUT_PATH = BASE_DIR / ".tmp" / "sheet_data.json"
 
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
@@ -44,8 +56,8 @@ def get_credentials() -> Credentials:
     creds = None
 
     if TOKEN_PATH.exists():
-        with open(TOKEN_PATH) as f:
-            token_data = json.load(f)
+        token_bytes = TOKEN_PATH.read_bytes()
+        token_data = orjson.loads(token_bytes) if orjson is not None else json.loads(token_bytes)
         creds = Credentials.from_authorized_user_info(token_data, SCOPES)
 
     if not creds or not creds.valid:
@@ -61,14 +73,25 @@ def get_credentials() -> Credentials:
             creds = flow.run_local_server(port=0)
 
         # Persist the (possibly new) token
-        with open(TOKEN_PATH, "w") as f:
-            f.write(creds.to_json())
+        TOKEN_PATH.write_text(creds.to_json())
 
     return creds
 
 # ---------------------------------------------------------------------------
 # Fetch
 # ---------------------------------------------------------------------------
+def _cell_to_str(value) -> str:
+    """
+    Return the raw unformatted cell value as a string — str() of the number
+    (e.g. 0.5 for a cell displayed as 50%), or TRUE / FALSE for booleans.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
 def fetch_sheet() -> list[dict]:
     """Read all rows from the target sheet, return as list of dicts keyed by header."""
     creds  = get_credentials()
@@ -78,21 +101,34 @@ def fetch_sheet() -> list[dict]:
     response = (
         client.spreadsheets()
         .values()
-        .get(spreadsheetId=SHEET_ID, range=range_notation)
+        .batchGet(
+            spreadsheetId=SHEET_ID,
+            ranges=[range_notation],
+            valueRenderOption=VALUE_RENDER_OPTION,
+            dateTimeRenderOption="FORMATTED_STRING",
+        )
         .execute()
     )
 
-    values = response.get("values", [])
+    value_ranges = response.get("valueRanges", [])
+    values = value_ranges[0].get("values", []) if value_ranges else []
     if len(values) < 2:
         print("Sheet has no data rows (only headers or is empty).")
         return []
 
+    if VALUE_RENDER_OPTION != "FORMATTED_VALUE":
+        # Unformatted cells may be numbers or booleans; keep every cell a
+        # string so downstream filtering and TEXT columns see one type.
+        values = [[_cell_to_str(v) for v in row] for row in values]
+
     headers  = values[0]
     num_cols = len(headers)
     # Pad rows: Google Sheets API omits trailing empty cells.
-    # zip() truncates to the shortest iterable, which would silently drop columns.
+    # zip() truncates to the shortest iterable, which would silently drop columns;
+    # zip_longest pads in place without building a padded copy of each row.
+    # Cells beyond the header row have no column, so overlong rows are truncated.
     rows = [
-        dict(zip(headers, row + [""] * (num_cols - len(row))))
+        dict(zip_longest(headers, row if len(row) <= num_cols else row[:num_cols], fillvalue=""))
         for row in values[1:]
     ]
     return rows
@@ -109,8 +145,16 @@ def main():
     print(f"  -> {len(rows)} row(s) fetched.")
 
     OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
-        json.dump(rows, f, indent=2, ensure_ascii=False)
+    if orjson is not None:
+        data = orjson.dumps(rows, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(rows, indent=2, ensure_ascii=False).encode("utf-8")
+
+    # Write to a temp file and swap it in, so a crash mid-write never leaves
+    # a truncated sheet_data.json for the next step to read
+    tmp_path = OUTPUT_PATH.with_name(OUTPUT_PATH.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, OUTPUT_PATH)
 
     print(f"  -> Written to {OUTPUT_PATH}")
 
@@ -2,22 +2,30 @@
 upsert_to_supabase.py
 ---------------------
 Reads .tmp/sheet_data.json, applies the column mapping from .env,
-and upserts the rows into the target Supabase table.
+and upserts the rows into the target Supabase table in batches of
+UPSERT_BATCH_SIZE rows, with up to UPSERT_CONCURRENCY batches in flight.
 
 Requires:
-  - .env  (SUPABASE_URL, SUPABASE_KEY, SUPABASE_TABLE, SUPABASE_PK, COLUMN_MAP)
+  - .env  (SUPABASE_URL, SUPABASE_KEY, SUPABASE_TABLE, SUPABASE_PK, COLUMN_MAP;
+           optional UPSERT_BATCH_SIZE, UPSERT_CONCURRENCY)
   - .tmp/sheet_data.json  (output of fetch_google_sheet.py)
 
 Install dependencies:
-  pip install supabase python-dotenv
+  pip install supabase httpx ijson python-dotenv
 """
 
+import asyncio
 import json
 import os
+from collections.abc import Iterable, Iterator
+from itertools import islice
 from pathlib import Path
 
+import httpx
+import ijson
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from postgrest import ReturnMethod
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
 
 # ---------------------------------------------------------------------------
 # Config
@@ -30,75 +38,161 @@ SUPABASE_KEY  = os.getenv("SUPABASE_KEY")
 TABLE_NAME    = os.getenv("SUPABASE_TABLE")
 PK_COLUMN     = os.getenv("SUPABASE_PK")
 COLUMN_MAP_RAW = os.getenv("COLUMN_MAP", "{}")  # JSON: {"Sheet Header": "supabase_col"}
+BATCH_SIZE    = int(os.getenv("UPSERT_BATCH_SIZE", "500"))  # rows per upsert request
+CONCURRENCY   = int(os.getenv("UPSERT_CONCURRENCY", "4"))   # upsert requests in flight
 
 INPUT_PATH = BASE_DIR / ".tmp" / "sheet_data.json"
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
-def get_client() -> Client:
+async def get_client() -> AsyncClient:
+    """
+    Create the async Supabase client.  main() creates one per run and shares
+    it across every upsert.
+
+    The client runs on our own httpx.AsyncClient so every request shares one
+    bounded keep-alive pool — one TLS handshake per connection, then
+    keep-alive POSTs — and failed connection attempts are retried by the
+    transport.
+    """
     if not SUPABASE_URL or not SUPABASE_KEY:
         raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def apply_column_map(rows: list[dict], col_map: dict) -> list[dict]:
-    """Rename keys in each row according to col_map. Unmapped keys are kept as-is."""
-    mapped = []
+    http_client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+        ),
+        timeout=120,
+        follow_redirects=True,
+    )
+    return await acreate_client(
+        SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(httpx_client=http_client)
+    )
+
+def apply_column_map(rows: Iterable[dict], col_map: dict) -> Iterator[dict]:
+    """
+    Lazily rename keys in each row according to col_map. Unmapped keys are kept as-is.
+
+    Every row has the same keys in the same order (fetch_google_sheet.py pads
+    each row to the full header), so the renamed key list is built once from
+    the first row and zipped against each row's values.
+    """
+    renamed_keys = None
     for row in rows:
-        new_row = {}
-        for key, value in row.items():
-            new_key = col_map.get(key, key)
-            new_row[new_key] = value
-        mapped.append(new_row)
-    return mapped
+        if renamed_keys is None:
+            renamed_keys = [col_map.get(key, key) for key in row]
+        yield dict(zip(renamed_keys, row.values()))
+
+
+def iter_json_array(path: Path) -> Iterator[dict]:
+    """Stream the items of the top-level JSON array in path, one at a time."""
+    with open(path, "rb") as f:
+        events = ijson.parse(f, use_float=True)
+        _, event, _ = next(events, (None, None, None))
+        if event != "start_array":
+            raise ValueError(f"Expected a JSON array in {path}; got {event or 'nothing'}")
+        yield from ijson.items(events, "item")
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yield successive lists of up to `size` items from iterable."""
+    it = iter(iterable)
+    while chunk := list(islice(it, size)):
+        yield chunk
 
 # ---------------------------------------------------------------------------
 # Upsert
 # ---------------------------------------------------------------------------
-def upsert_rows(client: Client, rows: list[dict]):
-    """Upsert rows into Supabase, resolving conflicts on PK_COLUMN."""
-    if not rows:
-        print("No rows to upsert.")
-        return
-
-    response = (
-        client.table(TABLE_NAME)
-        .upsert(rows, options={"resolution": "merge", "conflict": PK_COLUMN})
-        .execute()
-    )
-    return response
+async def upsert_rows(client: AsyncClient, rows: Iterable[dict]) -> int:
+    """
+    Upsert rows into Supabase in BATCH_SIZE chunks, resolving conflicts on
+    PK_COLUMN, with up to CONCURRENCY chunks in flight.  Returns the number
+    of rows sent.
+
+    `returning=minimal` tells PostgREST not to echo the rows back, so each
+    response is empty rather than a copy of the request.
+    """
+    sem     = asyncio.Semaphore(CONCURRENCY)
+    pending = set()
+    total   = 0
+
+    async def upsert_chunk(chunk: list[dict]) -> None:
+        nonlocal total
+        try:
+            await (
+                client.table(TABLE_NAME)
+                .upsert(chunk, on_conflict=PK_COLUMN, returning=ReturnMethod.minimal)
+                .execute()
+            )
+        finally:
+            sem.release()
+        total += len(chunk)
+        print(f"  → {total} row(s) upserted ...")
+
+    try:
+        batches = chunked(rows, BATCH_SIZE)
+        while True:
+            # Wait for a free slot before reading the next batch off the stream,
+            # so at most CONCURRENCY batches are held in memory.
+            await sem.acquire()
+
+            # Don't send more batches once one has failed
+            for task in [t for t in pending if t.done()]:
+                pending.discard(task)
+                task.result()
+
+            chunk = next(batches, None)
+            if chunk is None:
+                sem.release()
+                break
+            pending.add(asyncio.create_task(upsert_chunk(chunk)))
+
+        await asyncio.gather(*pending)
+    except BaseException:
+        # Stop the in-flight batches and wait for them, so none outlive the
+        # client main() is about to close and no error goes unretrieved
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+    return total
 
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
-def main():
+async def main():
     if not TABLE_NAME or not PK_COLUMN:
         raise ValueError("SUPABASE_TABLE and SUPABASE_PK must be set in .env")
+    if BATCH_SIZE < 1:
+        raise ValueError(f"UPSERT_BATCH_SIZE must be at least 1; got {BATCH_SIZE}")
+    if CONCURRENCY < 1:
+        raise ValueError(f"UPSERT_CONCURRENCY must be at least 1; got {CONCURRENCY}")
 
     if not INPUT_PATH.exists():
         raise FileNotFoundError(
             f"{INPUT_PATH} not found. Run fetch_google_sheet.py first."
         )
 
-    # Load intermediate data
-    with open(INPUT_PATH, encoding="utf-8") as f:
-        rows = json.load(f)
-
-    if not rows:
+    col_map = json.loads(COLUMN_MAP_RAW)
+    client  = await get_client()
+
+    # Stream intermediate data, apply column mapping, and upsert batch by
+    # batch, so only the in-flight batches are held in memory.
+    print(f"Upserting into '{TABLE_NAME}' (PK: {PK_COLUMN}) in batches of {BATCH_SIZE}, "
+          f"{CONCURRENCY} in flight ...")
+    try:
+        rows  = iter_json_array(INPUT_PATH)
+        total = await upsert_rows(client, apply_column_map(rows, col_map))
+    finally:
+        await client.postgrest.aclose()
+
+    if not total:
         print("sheet_data.json is empty — nothing to upsert.")
         return
 
-    # Apply column mapping
-    col_map = json.loads(COLUMN_MAP_RAW)
-    mapped_rows = apply_column_map(rows, col_map)
-    print(f"Mapped {len(mapped_rows)} row(s) using COLUMN_MAP.")
-
-    # Upsert
-    client = get_client()
-    print(f"Upserting into '{TABLE_NAME}' (PK: {PK_COLUMN}) ...")
-    response = upsert_rows(client, mapped_rows)
-
-    print(f"  → Done. Supabase response count: {len(response.data) if response.data else 0}")
+    print(f"  → Done. {total} row(s) mapped using COLUMN_MAP and upserted.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())